@@ -27,16 +27,217 @@ code when required.
  */
 """
 
-import sys
+# patch before anything else is imported so that subprocess pipes,
+# sockets and sleeps yield to other greenlets instead of blocking the
+# server
+from gevent import monkey
+monkey.patch_all(subprocess=True, thread=False)
+
 import os
-import json
 import subprocess
-import codecs
+import signal
+import struct
+import functools
+import json
+import re
+import gevent
+import gevent.lock
 import flask
+import orjson
 from gevent.pywsgi import WSGIServer
+from gevent.fileobject import FileObjectPosix
 import zipfile
-import io
-import base64
+import tempfile
+import pybase64
+from isal import isal_zlib
+
+# inflate zipped actions with the SIMD accelerated ISA-L implementation of
+# zlib; only the decompressor is replaced, compression (ISA-L supports
+# levels 0-3 only) and all other methods stay with zipfile's defaults
+_zipDecompressor = zipfile._get_decompressor
+
+
+def isalDecompressor(compress_type):
+    if compress_type == zipfile.ZIP_DEFLATED:
+        return isal_zlib.decompressobj(-15)
+    return _zipDecompressor(compress_type)
+
+
+zipfile._get_decompressor = isalDecompressor
+
+# a number of 19 or more digits may be an integer outside the 64 bit range,
+# which orjson silently turns into a float. Digit runs that follow a quote,
+# a letter, a digit or a dot (ids and timestamps sent as strings, fractions)
+# are not numbers of that kind and keep the fast path.
+LONG_NUMBER = re.compile(rb'(?<![\w."])-?\d{19}')
+
+
+# float subclass for NaN and (-)Infinity: orjson refuses to serialize it,
+# so dumpJson falls back to json, which writes the constant back unchanged
+class JsonConstant(float):
+    pass
+
+
+# parses JSON text (str or bytes) with orjson, falling back to the json
+# module for what orjson rejects (NaN, Infinity) or may silently round
+# (integers beyond 64 bits)
+def loadJson(data):
+    raw = data.encode('utf-8') if isinstance(data, str) else data
+    if not LONG_NUMBER.search(raw):
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(raw, parse_constant=JsonConstant)
+
+
+# serializes obj to JSON bytes with orjson, falling back to the json module
+# for what orjson cannot represent (see loadJson)
+def dumpJson(obj):
+    try:
+        return orjson.dumps(obj)
+    except TypeError:
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+# archives decoded in initCodeFromZip stay in memory up to this size
+# before they are spilled to a temporary file
+ZIP_SPOOL_SIZE = 16 * 1024 * 1024
+# largest result frame accepted from a persistent action process; a larger
+# length prefix means the process wrote something else (e.g. a log line) to
+# its stdout
+MAX_RESULT_FRAME_SIZE = 64 * 1024 * 1024
+# number of base64 characters decoded at a time (a multiple of 4)
+B64_CHUNK_SIZE = 4 * 64 * 1024
+# characters outside the base64 alphabet, which are discarded when decoding
+NON_BASE64 = re.compile('[^A-Za-z0-9+/=]')
+
+
+# decodes the base64 string code into the binary file object out one
+# chunk at a time, so that the decoded data is never held in memory twice.
+# Chunks are decoded with pybase64, which uses SIMD kernels where available.
+# Like base64.b64decode, characters outside the base64 alphabet (e.g.
+# newlines) are discarded; a chunk is only decoded up to a multiple of four
+# characters and the remainder is carried over to the next chunk.
+def b64decodeInto(code, out):
+    rest = ''
+    for i in range(0, len(code), B64_CHUNK_SIZE):
+        chunk = rest + NON_BASE64.sub('', code[i:i + B64_CHUNK_SIZE])
+        end = len(chunk) - len(chunk) % 4
+        out.write(pybase64.b64decode(chunk[:end], validate=False))
+        rest = chunk[end:]
+    if rest:
+        out.write(pybase64.b64decode(rest, validate=False))
+    out.seek(0)
+
+
+# writes all of data to the file descriptor fd, bypassing the buffers of
+# sys.stdout/sys.stderr so that no flush is needed
+def writeAll(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+# an action process started with os.posix_spawn, with its stdin, stdout and
+# stderr connected to pipes. Unlike the (gevent patched) subprocess.Popen,
+# which forks, posix_spawn does not copy the page tables of the proxy to
+# start the process. The proxy's ends of the pipes are unbuffered gevent
+# file objects, so that waiting on them yields to other greenlets and they
+# are never closed while gevent still watches them.
+class SpawnedProcess:
+    def __init__(self, argv, env):
+        self.stdin = self.stdout = self.stderr = None
+        stdin, stdinWriter = os.pipe()
+        stdoutReader, stdout = os.pipe()
+        stderrReader, stderr = os.pipe()
+        try:
+            self.pid = os.posix_spawn(
+                argv[0], argv, env,
+                file_actions=[
+                    (os.POSIX_SPAWN_DUP2, stdin, 0),
+                    (os.POSIX_SPAWN_DUP2, stdout, 1),
+                    (os.POSIX_SPAWN_DUP2, stderr, 2)],
+                # like subprocess, do not pass on the signals Python ignores
+                setsigdef=(signal.SIGPIPE, signal.SIGXFSZ))
+        except Exception:
+            os.close(stdinWriter)
+            os.close(stdoutReader)
+            os.close(stderrReader)
+            raise
+        finally:
+            os.close(stdin)
+            os.close(stdout)
+            os.close(stderr)
+        self.stdin = FileObjectPosix(stdinWriter, 'wb', 0)
+        self.stdout = FileObjectPosix(stdoutReader, 'rb', 0)
+        self.stderr = FileObjectPosix(stderrReader, 'rb', 0)
+
+    # closes the pipe ends held by the proxy
+    def close(self):
+        for pipe in (self.stdin, self.stdout, self.stderr):
+            if pipe is not None:
+                pipe.close()
+
+    # reaps the process without blocking the other greenlets: the patched
+    # os.waitpid only waits cooperatively for processes forked by gevent, so
+    # the process is polled, backing off up to 50 ms between polls
+    def wait(self):
+        delay = 0.0005
+        try:
+            while os.waitpid(self.pid, os.WNOHANG)[0] == 0:
+                gevent.sleep(delay)
+                delay = min(delay * 2, 0.05)
+        except ChildProcessError:
+            # already reaped by the child watcher of gevent
+            pass
+
+
+# writes payload to the stdin of the spawned process p
+def feed(p, payload):
+    view = memoryview(payload)
+    try:
+        while view:
+            view = view[p.stdin.write(view):]
+    except BrokenPipeError:
+        # the process does not read (all of) its input
+        pass
+    p.stdin.close()
+
+
+# reads the pipe until it is closed, extending buf
+def drain(pipe, buf):
+    for chunk in iter(lambda: pipe.read(65536), b''):
+        buf += chunk
+
+
+# writes payload to the stdin of the spawned process p and collects its
+# stdout and stderr until both are closed, then waits for the process to
+# exit. Like Popen.communicate, the three pipes are served by separate
+# greenlets, but each output is read straight into one growing bytearray
+# rather than joined from a list of chunks.
+# @return (stdout, stderr) as bytearrays
+def communicate(p, payload):
+    out, err = bytearray(), bytearray()
+    greenlets = [
+        gevent.spawn(feed, p, payload),
+        gevent.spawn(drain, p.stdout, out),
+        gevent.spawn(drain, p.stderr, err)]
+    try:
+        gevent.joinall(greenlets, raise_error=True)
+    finally:
+        gevent.killall(greenlets)
+        p.close()
+        p.wait()
+    return out, err
+
+
+# maps an invoker metadata key (e.g. api_key) to its environment variable
+# name (__OW_API_KEY); the key set is practically fixed, so the names are
+# cached across activations
+@functools.lru_cache(maxsize=64)
+def owEnvKey(k):
+    return '__OW_%s' % k.upper()
 
 
 class ActionRunner:
@@ -52,6 +253,25 @@ class ActionRunner:
         self.source = source if source else defaultBinary
         self.binary = binary if binary else defaultBinary
         self.zipdest = zipdest if zipdest else os.path.dirname(self.source)
+        # snapshot of the proxy environment every action environment starts from
+        self._baseEnv = dict(os.environ)
+        # set once <init> verified the binary, so that verify() does not stat
+        # the binary on every activation
+        self._verified = False
+        # keep the action running between activations instead of starting a
+        # new process per activation, enabled via an environment variable
+        # PROXY_PERSISTENT_ACTION == "1" (see runPersistent)
+        self.persistent = os.environ.get('PROXY_PERSISTENT_ACTION') == '1'
+        # seconds an activation of the persistent process may take before the
+        # process is killed, PROXY_PERSISTENT_TIMEOUT (default 300); only
+        # read in persistent mode
+        self.workerTimeout = None
+        if self.persistent:
+            self.workerTimeout = float(os.environ.get('PROXY_PERSISTENT_TIMEOUT', 300))
+        self.worker = None
+        self._workerLock = gevent.lock.BoundedSemaphore()
+        # reused for the length prefix of every frame sent to the worker
+        self._frameHeader = bytearray(4)
         os.chdir(os.path.dirname(self.source))
 
     def preinit(self):
@@ -77,6 +297,15 @@ class ActionRunner:
                 log("no prep")
                 return False
 
+        # the binary is about to be replaced, so it is unverified until the
+        # end of this initialization
+        self._verified = False
+        if self.persistent:
+            # stop a process left over from a previous initialization before
+            # its executable is overwritten (which fails while it runs)
+            with self._workerLock:
+                self.stopWorker()
+
         if prep():
             try:
                 # write source epilogue if any
@@ -91,7 +320,10 @@ class ActionRunner:
                 return False
         # verify the binary exists and is executable
         verified=self.verify()
+        self._verified = verified
         log("verified: {}".format(verified))
+        if self.persistent and verified:
+            self.worker = self.startWorker()
         return verified
 
     # optionally appends source to the loaded code during <init>
@@ -104,23 +336,22 @@ class ActionRunner:
 
     # @return True iff binary exists and is executable, False otherwise
     def verify(self):
-        return (os.path.isfile(self.binary) and
-                os.access(self.binary, os.X_OK))
+        return self._verified or (os.path.isfile(self.binary) and
+                                  os.access(self.binary, os.X_OK))
 
     # constructs an environment for the action to run in
     # @param message is a JSON object received from invoker (should
     # contain 'value' and 'api_key' and other metadata)
     # @return an environment dictionary for the action process
     def env(self, message):
-        # make sure to include all the env vars passed in by the invoker
-        env = os.environ
-        for k, v in message.items():
-            if k != 'value':
-                env['__OW_%s' % k.upper()] = v
+        # make sure to include all the env vars passed in by the invoker;
+        # the proxy's own environment is left untouched
+        env = self._baseEnv.copy()
+        env.update({owEnvKey(k): v for k, v in message.items() if k != 'value'})
         return env
 
     def _error(self, msg):
-        sys.stdout.write('%s\n' % msg)
+        writeAll(1, ('%s\n' % msg).encode('utf-8'))
         return (502, {'error': msg})
 
     def stop(self, args, env):
@@ -142,55 +373,52 @@ class ActionRunner:
     # return JSON object result of running the action or an error dictionary
     # if action failed
     def run(self, args, env):
+        if self.persistent:
+            return self.runPersistent(args, env)
         try:
-            input = json.dumps(args)
-            if len(input) > 131071:  # MAX_ARG_STRLEN (131071) linux/binfmts.h
+            payload = dumpJson(args)
+            if len(payload) > 131071:  # MAX_ARG_STRLEN (131071) linux/binfmts.h
                 # pass argument via stdin
-                p = subprocess.Popen(
-                    [self.binary],
-                    stdin=subprocess.PIPE,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    env=env)
+                argv = [self.binary]
             else:
                 # pass argument via stdin and command parameter
-                p = subprocess.Popen(
-                    [self.binary, input],
-                    stdin=subprocess.PIPE,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    env=env)
+                argv = [self.binary, payload.decode('utf-8')]
             # run the process and wait until it completes.
-            # stdout/stderr will always be set because we passed PIPEs to Popen
-            (o, e) = p.communicate(input=input.encode())
+            (o, e) = communicate(SpawnedProcess(argv, env), payload)
 
         except Exception as e:
-            return self._error(e)
+            return self._error(str(e))
 
-        # stdout/stderr may be either text or bytes, depending on Python
-        # version, so if bytes, decode to text. Note that in Python 2
-        # a string will match both types; so also skip decoding in that case
-        if isinstance(o, bytes) and not isinstance(o, str):
-            o = o.decode('utf-8')
-        if isinstance(e, bytes) and not isinstance(e, str):
-            e = e.decode('utf-8')
+        # stdout/stderr are kept as bytes: the logs are passed through to the
+        # proxy's own streams undecoded and only the result line is decoded
 
         # get the last line of stdout, even if empty
-        lastNewLine = o.rfind('\n', 0, len(o) - 1)
+        lastNewLine = o.rfind(b'\n', 0, len(o) - 1)
         if lastNewLine != -1:
             # this is the result string to JSON parse
             lastLine = o[lastNewLine + 1:].strip()
             # emit the rest as logs to stdout (including last new line)
-            sys.stdout.write(o[:lastNewLine + 1])
+            writeAll(1, memoryview(o)[:lastNewLine + 1])
         else:
             # either o is empty or it is the result string
             lastLine = o.strip()
+        lastLine = lastLine.decode('utf-8', 'replace')
 
         if e:
-            sys.stderr.write(e)
+            writeAll(2, e)
+
+        return self.parseResult(lastLine)
 
+    # parses the result line of an action, ignoring surrounding whitespace
+    # @return (200, result) if lastLine is a JSON object, an error otherwise
+    def parseResult(self, lastLine):
+        lastLine = lastLine.strip()
+        # only a JSON object is a valid result, so anything else is an error
+        # without trying to parse it
+        if not lastLine.startswith('{'):
+            return self._error(lastLine)
         try:
-            json_output = json.loads(lastLine)
+            json_output = loadJson(lastLine)
             if isinstance(json_output, dict):
                 return (200, json_output)
             else:
@@ -198,26 +426,119 @@ class ActionRunner:
         except Exception:
             return self._error(lastLine)
 
+    # starts the long-lived action process used by runPersistent
+    def startWorker(self):
+        return subprocess.Popen(
+            [self.binary],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=self._baseEnv)
+
+    # terminates the long-lived action process, if any
+    def stopWorker(self):
+        if self.worker is not None:
+            if self.worker.poll() is None:
+                self.worker.kill()
+            self.worker.wait()
+            for pipe in (self.worker.stdin, self.worker.stdout, self.worker.stderr):
+                try:
+                    pipe.close()
+                except OSError:
+                    # unflushed input for a process that is gone
+                    pass
+            self.worker = None
+
+    # forwards the stderr of the persistent process to the proxy's stderr
+    # up to the log sentinel line that ends the logs of an activation
+    # @return True iff the sentinel was read, False if stderr was closed
+    def forwardWorkerLogs(self, worker):
+        for line in iter(worker.stderr.readline, b''):
+            if line == SENTINEL_LINE:
+                return True
+            writeAll(2, line)
+        return False
+
+    # runs the action in the long-lived process started during <init>.
+    # Each activation is sent to the process stdin as a 4 byte big endian
+    # length followed by a JSON object {"value": args, "env": metadata},
+    # where metadata holds the __OW_* variables of the activation. The
+    # process answers on stdout with a 4 byte big endian length followed by
+    # the JSON result. Its logs go to stderr, which is passed through to the
+    # proxy; it ends the logs of every activation with a LOG_SENTINEL line
+    # so that they are complete before the proxy writes its own sentinel.
+    # A process that exits, breaks the protocol or does not answer within
+    # <workerTimeout> seconds is killed and restarted on the next activation.
+    def runPersistent(self, args, env):
+        metadata = {k: v for k, v in env.items() if k.startswith('__OW_')}
+        payload = dumpJson({'value': args, 'env': metadata})
+        with self._workerLock:
+            logs = None
+            timeout = gevent.Timeout(
+                self.workerTimeout,
+                TimeoutError('the action process did not return a result in time'))
+            try:
+                with timeout:
+                    if self.worker is None or self.worker.poll() is not None:
+                        self.worker = self.startWorker()
+                    # drain stderr concurrently so that the process cannot
+                    # block on a full pipe before it returns its result
+                    logs = gevent.spawn(self.forwardWorkerLogs, self.worker)
+                    # the payload is written as is behind the header instead of
+                    # being copied into a single frame
+                    struct.pack_into('>I', self._frameHeader, 0, len(payload))
+                    self.worker.stdin.write(self._frameHeader)
+                    self.worker.stdin.write(payload)
+                    self.worker.stdin.flush()
+                    header = self.worker.stdout.read(4)
+                    if len(header) < 4:
+                        raise EOFError('the action process exited before returning a result')
+                    size = int.from_bytes(header, 'big')
+                    if size > MAX_RESULT_FRAME_SIZE:
+                        raise ValueError('the action process returned a malformed result frame')
+                    result = self.worker.stdout.read(size)
+                    if len(result) < size:
+                        raise EOFError('the action process exited before returning a result')
+                    if not logs.get():
+                        raise EOFError('the action process exited before ending its logs')
+            except Exception as e:
+                if logs is not None:
+                    logs.kill()
+                self.stopWorker()
+                return self._error(str(e))
+        return self.parseResult(result.decode('utf-8', 'replace'))
+
     # initialize code from inlined string
     def initCodeFromString(self, message):
-        with codecs.open(self.source, 'w', 'utf-8') as fp:
-            fp.write(message['code'])
+        data = message['code'].encode('utf-8')
+        fd = os.open(self.source, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            writeAll(fd, data)
+        finally:
+            os.close(fd)
         return True
 
     # initialize code from base64 encoded archive
     def initCodeFromZip(self, message):
         try:
-            bytes = base64.b64decode(message['code'])
-            bytes = io.BytesIO(bytes)
-            archive = zipfile.ZipFile(bytes)
-            archive.extractall(self.zipdest)
-            archive.close()
+            with tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_SIZE) as spool:
+                b64decodeInto(message['code'], spool)
+                with zipfile.ZipFile(spool) as archive:
+                    archive.extractall(self.zipdest)
             return True
         except Exception as e:
-            print('err', str(e))
+            writeAll(1, ('err %s\n' % e).encode('utf-8'))
             return False
 
 
+# the log sentinel as written after every activation
+SENTINEL_LINE = ('%s\n' % ActionRunner.LOG_SENTINEL).encode('utf-8')
+
+# fixed bodies of the life-cycle hook responses
+ONSTART_BODY = orjson.dumps({'msg': 'onStart'})
+ONPAUSE_BODY = orjson.dumps({'msg': 'onpause'})
+ONFINISH_BODY = orjson.dumps({'msg': 'onfinish'})
+
 proxy = flask.Flask(__name__)
 proxy.debug = False
 # disable re-initialization of the executable unless explicitly allowed via an environment
@@ -237,10 +558,10 @@ def setRunner(r):
 def init():
     if proxy.rejectReinit is True and proxy.initialized is True:
         msg = 'Cannot initialize the action more than once.'
-        sys.stderr.write(msg + '\n')
+        writeAll(2, ('%s\n' % msg).encode('utf-8'))
         return error(msg, 403)
 
-    message = flask.request.get_json(force=True, silent=True)
+    message = parseBody()
     log(message)
     if message and not isinstance(message, dict):
         flask.abort(404)
@@ -263,68 +584,72 @@ def init():
         return error('The action failed to generate or locate a binary with exception . See logs for details.', 502)
 
 
+# parses the request body as JSON, ignoring the content type; the raw body
+# is not cached on the request since it is not needed after parsing
+# @return the parsed JSON value, or None if the body is not valid JSON
+def parseBody():
+    try:
+        return loadJson(flask.request.get_data(cache=False))
+    except ValueError:
+        return None
+
+
+# serializes obj as the JSON body of a response with the given status code
+def respond(obj, code=200):
+    return flask.Response(dumpJson(obj), status=code, mimetype='application/json')
+
+
 def log(msg):
-    sys.stdout.write('%s\n' % msg)
-    sys.stdout.flush()
-    sys.stderr.write('%s\n' % msg)
-    sys.stderr.flush()
+    line = ('%s\n' % msg).encode('utf-8')
+    writeAll(1, line)
+    writeAll(2, line)
 
 
 def error(msg="Internal Error", code=500):
-    response = flask.jsonify({'error': msg})
-    response.status_code = code
-    return complete(response)
+    return complete(respond({'error': msg}, code))
 
 
 @proxy.route('/onstart', methods=['POST'])
 def start():
     if proxy.started is True:
         msg = 'Cannot trigger start the action more than once.'
-        sys.stderr.write(msg + '\n')
+        writeAll(2, ('%s\n' % msg).encode('utf-8'))
         return error(msg, 500)
 
     proxy.started = True
     log("onStart")
     runner.start()
-    response = flask.jsonify({'msg': 'onStart'})
-    response.status_code = 200
-    return response
+    return flask.Response(ONSTART_BODY, status=200, mimetype='application/json')
 
 
 @proxy.route('/onpause', methods=['POST'])
 def pause():
     log("onpause")
     runner.pause()
-    response = flask.jsonify({'msg': 'onpause'})
-    response.status_code = 200
-    return response
+    return flask.Response(ONPAUSE_BODY, status=200, mimetype='application/json')
 
 
 @proxy.route('/onfinish', methods=['POST'])
 def finish():
     log("onfinish")
     runner.stop()
-    response = flask.jsonify({'msg': 'onfinish'})
-    response.status_code = 200
-    return response
+    return flask.Response(ONFINISH_BODY, status=200, mimetype='application/json')
 
 
 @proxy.route('/run', methods=['POST'])
 def run():
 
-    message = flask.request.get_json(force=True, silent=True)
-    if message and not isinstance(message, dict):
+    message = parseBody() or {}
+    if not isinstance(message, dict):
+        return error('The action did not receive a dictionary as an argument.', 404)
+    args = message.get('value', {})
+    if not isinstance(args, dict):
         return error('The action did not receive a dictionary as an argument.', 404)
-    else:
-        args = message.get('value', {}) if message else {}
-        if not isinstance(args, dict):
-            return error('The action did not receive a dictionary as an argument.', 404)
 
     if runner.verify():
         try:
-            code, result = runner.run(args, runner.env(message or {}))
-            response = flask.jsonify(result)
-            response.status_code = code
+            code, result = runner.run(args, runner.env(message))
+            response = respond(result, code)
         except Exception as e:
             return error('Internal error. {}'.format(e), 500)
     else:
@@ -334,13 +659,16 @@ def run():
 
 def complete(response):
     # Add sentinel to stdout/stderr
-    log(ActionRunner.LOG_SENTINEL)
+    writeAll(1, SENTINEL_LINE)
+    writeAll(2, SENTINEL_LINE)
     return response
 
 
 def main():
     port = int(os.getenv('FLASK_PROXY_PORT', 8080))
-    server = WSGIServer(('0.0.0.0', port), proxy, log=None)
+    # maximum number of concurrently served connections (greenlet pool size)
+    connections = int(os.getenv('FLASK_PROXY_WORKER_CONNECTIONS', 1000))
+    server = WSGIServer(('0.0.0.0', port), proxy, spawn=connections, log=None)
     server.serve_forever()
 
 